@@ -5,50 +5,192 @@ Tracks connections, broadcasts messages, and manages heartbeats.
 """
 
 import argparse
+import array
 import json
+import os
 import sqlite3
 import sys
 import time
 import uuid
+from collections import defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass, field, asdict
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+from enum import Enum
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional: pip install blackroad_websocket_manager[fast]
+    orjson = None
+else:
+    # Types the stdlib can't encode are passed through so both paths reject them.
+    _ORJSON_OPTS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                    | orjson.OPT_PASSTHROUGH_DATACLASS)
 
 DB_PATH = Path.home() / ".blackroad" / "websocket-manager.db"
 
+# Heartbeats are buffered and written in one transaction once either limit is hit.
+HEARTBEAT_FLUSH_SIZE = 128
+HEARTBEAT_FLUSH_INTERVAL = 1.0
+
+# Hot-path statements, shared by every call site so sqlite3's statement
+# cache (cached_statements in get_db) always finds them.
+_SQL_INSERT_CONN = (
+    "INSERT OR REPLACE INTO connections(ws_id, agent, metadata, connected_at, "
+    "last_heartbeat, status, message_count) VALUES(?,?,?,?,?,?,?)"
+)
+_SQL_INSERT_MSG = (
+    "INSERT INTO messages(msg_id, msg_type, sender_id, recipient_id, content, delivered) "
+    "VALUES(?,?,?,?,?,1)"
+)
+_SQL_BROADCAST_MSG = (
+    "INSERT INTO messages(msg_id, msg_type, sender_id, recipient_id, content, "
+    "sent_at, delivered) "
+    "SELECT lower(hex(randomblob(16))), ?, ?, value, ?, ?, 1 FROM json_each(?)"
+)
+_SQL_UPDATE_HB = "UPDATE connections SET last_heartbeat=? WHERE ws_id=?"
+_SQL_INSERT_HB_LOG = "INSERT INTO heartbeat_log(ws_id, latency_ms, ts) VALUES(?,?,?)"
+_SQL_INC_MC = "UPDATE connections SET message_count=message_count+1 WHERE ws_id=?"
+_SQL_SELECT_ACTIVE = "SELECT * FROM connections WHERE status='active'"
+
+_ts_cache = {"t": 0.0, "s": ""}
+
+
+def _now_iso() -> str:
+    """UTC ISO timestamp, re-formatted at most every half second."""
+    t = time.time()
+    if t - _ts_cache["t"] > 0.5:
+        _ts_cache["s"] = datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None).isoformat()
+        _ts_cache["t"] = t
+    return _ts_cache["s"]
+
+
+def _msg_id() -> str:
+    return os.urandom(16).hex()
+
+
+def _json_default(obj: Any) -> Any:
+    # The stdlib counterpart of the types orjson encodes natively.
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _dumps(obj: Any) -> str:
+    """Compact, non-ASCII-escaped JSON; the stdlib handles anything orjson rejects."""
+    if orjson is not None:
+        try:
+            out = orjson.dumps(obj, option=_ORJSON_OPTS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, datetimes and dataclasses
+            pass
+        else:
+            # orjson writes NaN/Infinity as null, so anything with a null is
+            # re-encoded by the stdlib to keep non-finite floats intact.
+            if b"null" not in out:
+                return out.decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_json_default)
+
+
+def _encode_content(message: Any) -> str:
+    """Message payload as stored: strings pass through, anything else is JSON."""
+    if isinstance(message, str):
+        return message
+    return _dumps(message)
 
-@dataclass
+
+def _iso_to_ts(value: str) -> float:
+    """Epoch seconds for a stored UTC timestamp; unparseable values count as now."""
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+    except (ValueError, TypeError):
+        return time.time()
+
+
+@dataclass(slots=True)
 class Connection:
     ws_id: str
     agent: str
     metadata: Dict[str, Any] = field(default_factory=dict)
-    connected_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
-    last_heartbeat: str = field(default_factory=lambda: datetime.utcnow().isoformat())
+    connected_at: str = field(default_factory=_now_iso)
+    last_heartbeat: str = field(default_factory=_now_iso)
     status: str = "active"
     message_count: int = 0
     db_id: Optional[int] = None
+    last_heartbeat_ts: float = 0.0
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     content: Any
     sender_id: Optional[str] = None
     recipient_id: Optional[str] = None
     msg_type: str = "data"
-    msg_id: str = field(default_factory=lambda: str(uuid.uuid4()))
-    sent_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
+    msg_id: str = field(default_factory=_msg_id)
+    sent_at: str = field(default_factory=_now_iso)
     db_id: Optional[int] = None
 
 
 def get_db(db_path: Path = DB_PATH) -> sqlite3.Connection:
     db_path.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(str(db_path))
+    # Autocommit mode: multi-statement writes open their own transaction
+    # through _transaction() so each one costs a single commit.
+    conn = sqlite3.connect(str(db_path), isolation_level=None, cached_statements=512)
     conn.row_factory = sqlite3.Row
+    _tune(conn)
     _init_schema(conn)
     return conn
 
 
+def get_db_readonly(db_path: Path = DB_PATH) -> sqlite3.Connection:
+    """Read-only connection for queries; under WAL it never blocks the writer.
+
+    The database must already exist (open it once with get_db first).
+    """
+    conn = sqlite3.connect(db_path.resolve().as_uri() + "?mode=ro", uri=True,
+                           isolation_level=None, cached_statements=512)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=1")
+    _tune_cache(conn)
+    return conn
+
+
+def _tune(conn: sqlite3.Connection) -> None:
+    """WAL journal with relaxed fsync, plus the shared cache settings."""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _tune_cache(conn)
+
+
+def _tune_cache(conn: sqlite3.Connection) -> None:
+    """Larger page cache, in-memory temp tables, mmap reads and a busy timeout."""
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA busy_timeout=5000")
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """Run a block of writes inside one explicit transaction (one commit).
+
+    On a default-isolation connection an implicit transaction may already be
+    open; the block then joins it and the final commit covers both.
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
 def _init_schema(conn: sqlite3.Connection) -> None:
     conn.executescript("""
         CREATE TABLE IF NOT EXISTS connections (
@@ -81,8 +223,15 @@ def _init_schema(conn: sqlite3.Connection) -> None:
             latency_ms  INTEGER
         );
 
+        -- Every persisted message counts towards its recipient.
+        CREATE TRIGGER IF NOT EXISTS inc_mc AFTER INSERT ON messages BEGIN
+            UPDATE connections SET message_count=message_count+1
+            WHERE ws_id=NEW.recipient_id;
+        END;
+
         CREATE INDEX IF NOT EXISTS idx_conn_agent  ON connections(agent);
         CREATE INDEX IF NOT EXISTS idx_conn_status ON connections(status);
+        CREATE INDEX IF NOT EXISTS idx_conn_hb     ON connections(status, last_heartbeat);
         CREATE INDEX IF NOT EXISTS idx_msg_recip   ON messages(recipient_id);
         CREATE INDEX IF NOT EXISTS idx_msg_sent    ON messages(sent_at);
     """)
@@ -90,87 +239,249 @@ def _init_schema(conn: sqlite3.Connection) -> None:
 
 
 class ConnectionPool:
-    """In-memory connection pool backed by SQLite."""
+    """In-memory connection pool backed by SQLite.
+
+    With lazy=True the active rows are only loaded on first lookup, so callers
+    that just register connections never read the table. The initial load
+    goes through reader (e.g. from get_db_readonly) when one is given.
+    """
 
-    def __init__(self, conn: sqlite3.Connection):
+    def __init__(self, conn: sqlite3.Connection, lazy: bool = False,
+                 reader: Optional[sqlite3.Connection] = None):
         self._conn = conn
+        self._reader = reader or conn
+        self._loaded = False
         self._pool: Dict[str, Connection] = {}
-        self._load_active()
+        # agent -> ws_ids; dict values are unused, it keeps insertion order.
+        self._by_agent: Dict[str, Dict[str, None]] = defaultdict(dict)
+        # Parallel arrays for sweeps: slot i holds _ids[i] and its heartbeat epoch.
+        self._ids: List[str] = []
+        self._hb_ts = array.array("d")
+        self._slot: Dict[str, int] = {}
+        self._hb_buffer: List[tuple] = []
+        self._hb_log_buffer: List[tuple] = []
+        self._hb_last_flush = time.monotonic()
+        if not lazy:
+            self._ensure_loaded()
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self._loaded = True
+            self._load_active()
 
     def _load_active(self) -> None:
-        rows = self._conn.execute(
-            "SELECT * FROM connections WHERE status='active'"
-        ).fetchall()
+        rows = self._reader.execute(_SQL_SELECT_ACTIVE).fetchall()
         for row in rows:
-            c = self._row_to_connection(row)
-            self._pool[c.ws_id] = c
+            # Connections added before a lazy load are already tracked.
+            if row["ws_id"] not in self._pool:
+                self._track(self._row_to_connection(row))
+
+    def _track(self, connection: Connection) -> None:
+        self._untrack(connection.ws_id)
+        self._pool[connection.ws_id] = connection
+        self._by_agent[connection.agent][connection.ws_id] = None
+        self._slot[connection.ws_id] = len(self._ids)
+        self._ids.append(connection.ws_id)
+        self._hb_ts.append(connection.last_heartbeat_ts)
+
+    def _untrack(self, ws_id: str) -> None:
+        self._untrack_many((ws_id,))
+
+    def _untrack_many(self, ws_ids) -> None:
+        gone = set()
+        for ws_id in ws_ids:
+            old = self._pool.pop(ws_id, None)
+            if old is None:
+                continue
+            gone.add(ws_id)
+            ids = self._by_agent[old.agent]
+            ids.pop(ws_id, None)
+            if not ids:
+                del self._by_agent[old.agent]
+        if not gone:
+            return
+        # Compact the arrays from the first freed slot on, keeping _pool order.
+        first = min(self._slot.pop(w) for w in gone)
+        tail_ids = [w for w in self._ids[first:] if w not in gone]
+        tail_ts = [self._hb_ts[self._slot[w]] for w in tail_ids]
+        del self._ids[first:]
+        del self._hb_ts[first:]
+        for i, w in enumerate(tail_ids, first):
+            self._slot[w] = i
+        self._ids.extend(tail_ids)
+        self._hb_ts.extend(tail_ts)
 
     @staticmethod
     def _row_to_connection(row) -> Connection:
+        meta = row["metadata"]
         return Connection(
             ws_id=row["ws_id"],
             agent=row["agent"],
-            metadata=json.loads(row["metadata"]),
+            # stdlib parse: orjson.loads turns integers beyond 64 bits into floats
+            metadata={} if meta == "{}" else json.loads(meta),
             connected_at=row["connected_at"],
             last_heartbeat=row["last_heartbeat"],
             status=row["status"],
             message_count=row["message_count"],
             db_id=row["id"],
+            last_heartbeat_ts=_iso_to_ts(row["last_heartbeat"]),
         )
 
     def add(self, connection: Connection) -> Connection:
+        if not connection.last_heartbeat_ts:
+            connection.last_heartbeat_ts = _iso_to_ts(connection.last_heartbeat)
+        meta_s = "{}" if not connection.metadata else _dumps(connection.metadata)
         cur = self._conn.execute(
-            "INSERT OR REPLACE INTO connections(ws_id, agent, metadata, connected_at, "
-            "last_heartbeat, status, message_count) VALUES(?,?,?,?,?,?,?)",
-            (connection.ws_id, connection.agent, json.dumps(connection.metadata),
+            _SQL_INSERT_CONN,
+            (connection.ws_id, connection.agent, meta_s,
              connection.connected_at, connection.last_heartbeat, connection.status,
              connection.message_count),
         )
         connection.db_id = cur.lastrowid
         self._conn.commit()
-        self._pool[connection.ws_id] = connection
+        self._track(connection)
         return connection
 
+    def add_many(self, connections: List[Connection]) -> List[Connection]:
+        """Register many connections with one executemany in a single transaction."""
+        if not connections:
+            return connections
+        rows = []
+        for c in connections:
+            if not c.last_heartbeat_ts:
+                c.last_heartbeat_ts = _iso_to_ts(c.last_heartbeat)
+            rows.append((c.ws_id, c.agent, "{}" if not c.metadata else _dumps(c.metadata),
+                         c.connected_at, c.last_heartbeat, c.status, c.message_count))
+        # Keep dirty pages in the cache until COMMIT rather than spilling mid-batch.
+        spill = self._conn.execute("PRAGMA cache_spill").fetchone()[0]
+        self._conn.execute("PRAGMA cache_spill=0")
+        try:
+            with _transaction(self._conn):
+                self._conn.executemany(_SQL_INSERT_CONN, rows)
+                ids = dict(self._conn.execute(
+                    "SELECT ws_id, id FROM connections "
+                    "WHERE ws_id IN (SELECT value FROM json_each(?))",
+                    (json.dumps([c.ws_id for c in connections]),),
+                ).fetchall())
+        finally:
+            self._conn.execute(f"PRAGMA cache_spill={int(spill)}")
+        for c in connections:
+            c.db_id = ids.get(c.ws_id)
+            self._track(c)
+        return connections
+
     def remove(self, ws_id: str) -> bool:
+        self._ensure_loaded()
         if ws_id not in self._pool:
             return False
+        self._flush_heartbeats()
         self._conn.execute(
             "UPDATE connections SET status='disconnected', disconnected_at=datetime('now') WHERE ws_id=?",
             (ws_id,),
         )
         self._conn.commit()
-        del self._pool[ws_id]
+        self._untrack(ws_id)
         return True
 
+    def remove_many(self, ws_ids: List[str]) -> List[str]:
+        """Disconnect several connections with one UPDATE; returns the ids removed."""
+        self._ensure_loaded()
+        removed = [w for w in ws_ids if w in self._pool]
+        if not removed:
+            return removed
+        self._flush_heartbeats()
+        self._conn.execute(
+            "UPDATE connections SET status='disconnected', disconnected_at=datetime('now') "
+            "WHERE ws_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(removed),),
+        )
+        self._conn.commit()
+        self._untrack_many(removed)
+        return removed
+
     def get(self, ws_id: str) -> Optional[Connection]:
+        self._ensure_loaded()
         return self._pool.get(ws_id)
 
     def get_all(self) -> List[Connection]:
+        self._ensure_loaded()
         return list(self._pool.values())
 
     def count(self) -> int:
+        self._ensure_loaded()
         return len(self._pool)
 
+    def by_agent(self, agent: str) -> List[Connection]:
+        self._ensure_loaded()
+        return [self._pool[w] for w in self._by_agent.get(agent, ())]
+
+    def partition_by_heartbeat(self, cutoff_ts: float) -> Tuple[List[str], List[str]]:
+        """Split pooled ids into (fresh, stale) by last heartbeat vs cutoff_ts."""
+        self._ensure_loaded()
+        fresh, stale = [], []
+        for ws_id, ts in zip(self._ids, self._hb_ts):
+            (stale if ts < cutoff_ts else fresh).append(ws_id)
+        return fresh, stale
+
+    def agent_counts(self) -> Dict[str, int]:
+        self._ensure_loaded()
+        return {a: len(ids) for a, ids in self._by_agent.items()}
+
     def update_heartbeat(self, ws_id: str, latency_ms: Optional[int] = None) -> bool:
+        self._ensure_loaded()
         if ws_id not in self._pool:
             return False
-        ts = datetime.utcnow().isoformat()
-        self._pool[ws_id].last_heartbeat = ts
-        self._conn.execute(
-            "UPDATE connections SET last_heartbeat=? WHERE ws_id=?", (ts, ws_id)
-        )
-        self._conn.execute(
-            "INSERT INTO heartbeat_log(ws_id, latency_ms) VALUES(?,?)", (ws_id, latency_ms)
-        )
-        self._conn.commit()
+        ts = _now_iso()
+        conn_obj = self._pool[ws_id]
+        conn_obj.last_heartbeat = ts
+        conn_obj.last_heartbeat_ts = self._hb_ts[self._slot[ws_id]] = time.time()
+        self._hb_buffer.append((ts, ws_id))
+        self._hb_log_buffer.append((ws_id, latency_ms, ts))
+        if (len(self._hb_buffer) >= HEARTBEAT_FLUSH_SIZE
+                or time.monotonic() - self._hb_last_flush > HEARTBEAT_FLUSH_INTERVAL):
+            self._flush_heartbeats()
         return True
 
+    def _flush_heartbeats(self) -> None:
+        self._hb_last_flush = time.monotonic()
+        if not self._hb_buffer:
+            return
+        hb, log = self._hb_buffer, self._hb_log_buffer
+        self._hb_buffer, self._hb_log_buffer = [], []
+        with _transaction(self._conn):
+            self._conn.executemany(_SQL_UPDATE_HB, hb)
+            self._conn.executemany(_SQL_INSERT_HB_LOG, log)
+
+    def flush(self) -> None:
+        """Write out any buffered heartbeats."""
+        self._flush_heartbeats()
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> "ConnectionPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        # Last-chance flush; the connection may already be closed at shutdown.
+        try:
+            self._flush_heartbeats()
+        except Exception:
+            pass
+
     def increment_message_count(self, ws_id: str) -> None:
+        """Count a delivery that is NOT stored in the messages table.
+
+        Rows inserted into messages (send_message, broadcast) are already
+        counted by the inc_mc trigger; calling this for them double-counts.
+        """
+        self._ensure_loaded()
         if ws_id in self._pool:
             self._pool[ws_id].message_count += 1
-            self._conn.execute(
-                "UPDATE connections SET message_count=message_count+1 WHERE ws_id=?", (ws_id,)
-            )
+            self._conn.execute(_SQL_INC_MC, (ws_id,))
             self._conn.commit()
 
 
@@ -191,35 +502,33 @@ def broadcast(
     filter_fn: Optional[Callable[[Connection], bool]] = None,
     msg_type: str = "broadcast",
     sender_id: Optional[str] = None,
+    agent: Optional[str] = None,
 ) -> List[str]:
     """
     Broadcast message to all (optionally filtered) connections.
+    Passing agent limits targets to that agent via the pool's agent index.
     Returns list of ws_ids that received the message.
     Persists to messages table.
     """
-    targets = pool.get_all()
+    targets = pool.by_agent(agent) if agent is not None else pool.get_all()
     if filter_fn:
         targets = [c for c in targets if filter_fn(c)]
 
-    content_str = json.dumps(message) if not isinstance(message, str) else message
-    delivered_to = []
+    content_str = _encode_content(message)
+    sent_at = _now_iso()
+    delivered_to = [c.ws_id for c in targets]
 
-    for conn_obj in targets:
-        msg = Message(
-            content=content_str,
-            sender_id=sender_id,
-            recipient_id=conn_obj.ws_id,
-            msg_type=msg_type,
-        )
-        db_conn.execute(
-            "INSERT INTO messages(msg_id, msg_type, sender_id, recipient_id, content, delivered) "
-            "VALUES(?,?,?,?,?,1)",
-            (msg.msg_id, msg.msg_type, msg.sender_id, msg.recipient_id, msg.content),
-        )
-        pool.increment_message_count(conn_obj.ws_id)
-        delivered_to.append(conn_obj.ws_id)
+    # One statement fans the message out: SQLite expands the recipient array
+    # with json_each and generates each msg_id itself; the inc_mc trigger
+    # bumps each recipient's message_count.
+    db_conn.execute(
+        _SQL_BROADCAST_MSG,
+        (msg_type, sender_id, content_str, sent_at, json.dumps(delivered_to)),
+    )
+    db_conn.commit()  # no-op in get_db's autocommit mode
 
-    db_conn.commit()
+    for conn_obj in targets:
+        conn_obj.message_count += 1
     return delivered_to
 
 
@@ -237,23 +546,36 @@ def heartbeat_check(
     Removes stale connections (no heartbeat within timeout seconds).
     Returns {'active': [...], 'timed_out': [...]}.
     """
-    now = datetime.utcnow()
-    cutoff = now - timedelta(seconds=timeout)
-    active = []
-    timed_out = []
-
-    for conn_obj in list(pool.get_all()):
-        try:
-            last_hb = datetime.fromisoformat(conn_obj.last_heartbeat)
-        except (ValueError, AttributeError):
-            last_hb = now
+    pool.flush()
+    active, timed_out = pool.partition_by_heartbeat(time.time() - timeout)
+    pool.remove_many(timed_out)
+    return {"active": active, "timed_out": timed_out}
 
-        if last_hb < cutoff:
-            pool.remove(conn_obj.ws_id)
-            timed_out.append(conn_obj.ws_id)
-        else:
-            active.append(conn_obj.ws_id)
 
+def heartbeat_check_sql(
+    db_conn: sqlite3.Connection,
+    timeout: int = 30,
+    pool: Optional[ConnectionPool] = None,
+) -> Dict[str, List[str]]:
+    """
+    Timeout sweep done entirely in SQLite, judged on the stored last_heartbeat.
+    Heartbeats a pool still holds in its buffer are invisible here: pass that
+    pool to have it flushed first. Does not update any pool's in-memory state.
+    Returns {'active': [...], 'timed_out': [...]}.
+    """
+    if pool is not None:
+        pool.flush()
+    # julianday() normalises both the ISO 'T' form we write and the schema's
+    # datetime('now') default, which would mis-sort as plain text.
+    timed_out = [r[0] for r in db_conn.execute(
+        "UPDATE connections SET status='disconnected', disconnected_at=datetime('now') "
+        "WHERE status='active' "
+        "AND julianday(last_heartbeat) < julianday('now', ?) RETURNING ws_id",
+        (f"-{timeout} seconds",),
+    ).fetchall()]
+    active = [r[0] for r in db_conn.execute(
+        "SELECT ws_id FROM connections WHERE status='active'"
+    )]
     return {"active": active, "timed_out": timed_out}
 
 
@@ -270,44 +592,56 @@ def send_message(
     if not conn_obj:
         return None
 
-    content_str = json.dumps(message) if not isinstance(message, str) else message
+    content_str = _encode_content(message)
     msg = Message(content=content_str, sender_id=sender_id,
                   recipient_id=ws_id, msg_type=msg_type)
     db_conn.execute(
-        "INSERT INTO messages(msg_id, msg_type, sender_id, recipient_id, content, delivered) "
-        "VALUES(?,?,?,?,?,1)",
+        _SQL_INSERT_MSG,
         (msg.msg_id, msg.msg_type, msg.sender_id, msg.recipient_id, msg.content),
     )
-    pool.increment_message_count(ws_id)
-    db_conn.commit()
+    db_conn.commit()  # no-op in get_db's autocommit mode
+    conn_obj.message_count += 1
     return msg
 
 
-def get_message_history(
+def iter_message_history(
     db_conn: sqlite3.Connection,
     ws_id: Optional[str] = None,
     limit: int = 50,
-) -> List[dict]:
+) -> Iterator[sqlite3.Row]:
+    """Stream the newest messages (optionally for one connection) without buffering."""
     if ws_id:
-        rows = db_conn.execute(
+        yield from db_conn.execute(
             "SELECT * FROM messages WHERE recipient_id=? OR sender_id=? "
-            "ORDER BY sent_at DESC LIMIT ?",
+            "ORDER BY id DESC LIMIT ?",
             (ws_id, ws_id, limit),
-        ).fetchall()
+        )
     else:
-        rows = db_conn.execute(
-            "SELECT * FROM messages ORDER BY sent_at DESC LIMIT ?", (limit,)
-        ).fetchall()
-    return [dict(r) for r in rows]
+        yield from db_conn.execute(
+            "SELECT * FROM messages ORDER BY id DESC LIMIT ?", (limit,)
+        )
+
+
+def get_message_history(
+    db_conn: sqlite3.Connection,
+    ws_id: Optional[str] = None,
+    limit: int = 50,
+) -> List[dict]:
+    return [dict(r) for r in iter_message_history(db_conn, ws_id=ws_id, limit=limit)]
 
 
-def connection_stats(pool: ConnectionPool, db_conn: sqlite3.Connection) -> dict:
+def connection_stats(pool: Optional[ConnectionPool], db_conn: sqlite3.Connection) -> dict:
+    """Connection/message totals; with pool=None the active figures come from SQL."""
     total_conn = db_conn.execute("SELECT COUNT(*) FROM connections").fetchone()[0]
     total_msg = db_conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
-    active = pool.count()
-    agents = {}
-    for c in pool.get_all():
-        agents[c.agent] = agents.get(c.agent, 0) + 1
+    if pool is None:
+        agents = dict(db_conn.execute(
+            "SELECT agent, COUNT(*) FROM connections WHERE status='active' GROUP BY agent"
+        ).fetchall())
+        active = sum(agents.values())
+    else:
+        active = pool.count()
+        agents = pool.agent_counts()
     return {
         "active_connections": active,
         "total_ever_connected": total_conn,
@@ -368,8 +702,14 @@ def build_parser() -> argparse.ArgumentParser:
 
 def main(argv=None):
     args = build_parser().parse_args(argv)
-    db_conn = get_db(Path(args.db))
-    pool = ConnectionPool(db_conn)
+    db_path = Path(args.db)
+    db_conn = get_db(db_path)
+    # Only the pure read commands pay for a second, read-only connection.
+    read_conn = (get_db_readonly(db_path) if args.command in ("list", "history", "stats")
+                 else None)
+    # history, stats and heartbeat-check work straight off SQLite.
+    pool = (None if args.command in ("history", "stats", "heartbeat-check")
+            else ConnectionPool(db_conn, lazy=True, reader=read_conn))
 
     if args.command == "connect":
         ws_id = args.ws_id or str(uuid.uuid4())
@@ -387,12 +727,15 @@ def main(argv=None):
         conns = get_active_connections(pool)
         if not conns:
             print("No active connections.")
-        for c in conns:
-            print(f"  {c.ws_id[:16]}... agent={c.agent:20s} msgs={c.message_count:5d} hb={c.last_heartbeat[:19]}")
+        else:
+            sys.stdout.write("\n".join([
+                f"  {c.ws_id[:16]}... agent={c.agent:20s} msgs={c.message_count:5d} hb={c.last_heartbeat[:19]}"
+                for c in conns
+            ]) + "\n")
 
     elif args.command == "broadcast":
-        filt = (lambda c: c.agent == args.agent) if args.agent else None
-        delivered = broadcast(pool, db_conn, args.message, filter_fn=filt, msg_type=args.msg_type)
+        delivered = broadcast(pool, db_conn, args.message, msg_type=args.msg_type,
+                              agent=args.agent)
         print(f"Broadcast to {len(delivered)} connection(s)")
 
     elif args.command == "send":
@@ -404,23 +747,27 @@ def main(argv=None):
 
     elif args.command == "heartbeat":
         if pool.update_heartbeat(args.ws_id, args.latency):
+            pool.close()
             print(f"Heartbeat updated for {args.ws_id}")
         else:
             print("Connection not found", file=sys.stderr); sys.exit(1)
 
     elif args.command == "heartbeat-check":
-        result = heartbeat_check(pool, db_conn, timeout=args.timeout)
+        result = heartbeat_check_sql(db_conn, timeout=args.timeout)
         print(f"Active: {len(result['active'])}  Timed out: {len(result['timed_out'])}")
         for ws_id in result["timed_out"]:
             print(f"  Removed: {ws_id}")
 
     elif args.command == "history":
-        rows = get_message_history(db_conn, ws_id=args.ws_id, limit=args.limit)
-        for r in rows:
-            print(f"  [{r['sent_at'][:19]}] {r['msg_type']:12s} {r.get('content','')[:60]}")
+        lines = [
+            f"  [{r['sent_at'][:19]}] {r['msg_type']:12s} {(r['content'] or '')[:60]}"
+            for r in iter_message_history(read_conn, ws_id=args.ws_id, limit=args.limit)
+        ]
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
 
     elif args.command == "stats":
-        stats = connection_stats(pool, db_conn)
+        stats = connection_stats(None, read_conn)
         print(json.dumps(stats, indent=2))
 
 
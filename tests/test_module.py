@@ -1,7 +1,10 @@
 """Tests for blackroad-websocket-manager."""
 import json
+import sqlite3
 import sys
 import time
+import uuid
+from datetime import datetime
 from pathlib import Path
 
 import pytest
@@ -9,10 +12,10 @@ import pytest
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
 from main_module import (
-    Connection, ConnectionPool, Message, get_db,
+    Connection, ConnectionPool, Message, get_db, get_db_readonly,
     add_connection, remove_connection, broadcast,
-    get_active_connections, heartbeat_check, send_message,
-    get_message_history, connection_stats,
+    get_active_connections, heartbeat_check, heartbeat_check_sql, send_message,
+    get_message_history, iter_message_history, connection_stats,
 )
 
 
@@ -89,13 +92,13 @@ def test_heartbeat_update(pool):
     assert c.last_heartbeat is not None
 
 
-def test_heartbeat_check_timeout(pool, tmp_db):
-    add_connection(pool, "ws-stale", "stale-agent")
-    # Manually set last_heartbeat to past
+def test_heartbeat_check_timeout(tmp_db):
+    add_connection(ConnectionPool(tmp_db), "ws-stale", "stale-agent")
+    # Manually set last_heartbeat to past, then reload the pool from disk
     old_ts = "2020-01-01T00:00:00"
     tmp_db.execute("UPDATE connections SET last_heartbeat=? WHERE ws_id='ws-stale'", (old_ts,))
     tmp_db.commit()
-    pool._pool["ws-stale"].last_heartbeat = old_ts
+    pool = ConnectionPool(tmp_db)
 
     result = heartbeat_check(pool, tmp_db, timeout=30)
     assert "ws-stale" in result["timed_out"]
@@ -133,3 +136,291 @@ def test_message_count_increments(pool, tmp_db):
     send_message(pool, tmp_db, "ws-cnt", "c")
     c = pool.get("ws-cnt")
     assert c.message_count == 3
+
+
+def test_broadcast_increments_message_counts(pool, tmp_db):
+    add_connection(pool, "ws-bc1", "alice")
+    add_connection(pool, "ws-bc2", "alice")
+    broadcast(pool, tmp_db, "hello")
+    broadcast(pool, tmp_db, "again")
+    assert pool.get("ws-bc1").message_count == 2
+    row = tmp_db.execute(
+        "SELECT message_count FROM connections WHERE ws_id='ws-bc2'"
+    ).fetchone()
+    assert row[0] == 2
+
+
+def test_db_uses_wal(tmp_db):
+    mode = tmp_db.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+
+
+def test_heartbeats_buffered_until_close(pool, tmp_db):
+    add_connection(pool, "ws-buf", "cipher")
+    pool.update_heartbeat("ws-buf", latency_ms=3)
+    pool.update_heartbeat("ws-buf", latency_ms=4)
+    pool.close()
+    logged = tmp_db.execute(
+        "SELECT COUNT(*) FROM heartbeat_log WHERE ws_id='ws-buf'"
+    ).fetchone()[0]
+    assert logged == 2
+    row = tmp_db.execute(
+        "SELECT last_heartbeat FROM connections WHERE ws_id='ws-buf'"
+    ).fetchone()
+    assert row[0] == pool.get("ws-buf").last_heartbeat
+
+
+def test_remove_many(pool, tmp_db):
+    add_connection(pool, "ws-m1", "alice")
+    add_connection(pool, "ws-m2", "alice")
+    add_connection(pool, "ws-m3", "alice")
+    removed = pool.remove_many(["ws-m1", "ws-m3", "ghost-ws"])
+    assert removed == ["ws-m1", "ws-m3"]
+    assert pool.get("ws-m1") is None
+    assert pool.get("ws-m2") is not None
+    statuses = dict(tmp_db.execute(
+        "SELECT ws_id, status FROM connections WHERE ws_id LIKE 'ws-m%'"
+    ).fetchall())
+    assert statuses == {"ws-m1": "disconnected", "ws-m2": "active", "ws-m3": "disconnected"}
+
+
+def test_broadcast_by_agent(pool, tmp_db):
+    add_connection(pool, "ws-g1", "alice")
+    add_connection(pool, "ws-g2", "octavia")
+    add_connection(pool, "ws-g3", "alice")
+    remove_connection(pool, "ws-g3")
+    delivered = broadcast(pool, tmp_db, "hi", agent="alice")
+    assert delivered == ["ws-g1"]
+    assert connection_stats(pool, tmp_db)["agents"] == {"alice": 1, "octavia": 1}
+
+
+def test_metadata_survives_reload(pool, tmp_db):
+    add_connection(pool, "ws-meta", "alice", {"ip": "10.0.0.1", "n": 2**70})
+    add_connection(pool, "ws-bare", "alice")
+    reloaded = ConnectionPool(tmp_db)
+    assert reloaded.get("ws-meta").metadata == {"ip": "10.0.0.1", "n": 2**70}
+    assert reloaded.get("ws-bare").metadata == {}
+
+
+def test_history_newest_first(pool, tmp_db):
+    add_connection(pool, "ws-order", "alice")
+    for text in ("first", "second", "third"):
+        send_message(pool, tmp_db, "ws-order", text)
+    contents = [r["content"] for r in iter_message_history(tmp_db, ws_id="ws-order", limit=2)]
+    assert contents == ["third", "second"]
+
+
+def test_add_many(pool, tmp_db):
+    conns = [Connection(ws_id=f"ws-bulk{i}", agent="bulk") for i in range(5)]
+    pool.add_many(conns)
+    assert pool.count() == 5
+    assert all(c.db_id is not None for c in conns)
+    stored = tmp_db.execute(
+        "SELECT COUNT(*) FROM connections WHERE agent='bulk' AND status='active'"
+    ).fetchone()[0]
+    assert stored == 5
+    assert connection_stats(pool, tmp_db)["agents"] == {"bulk": 5}
+
+
+def test_heartbeat_check_after_removals(pool, tmp_db):
+    for i in range(4):
+        add_connection(pool, f"ws-sw{i}", "alice")
+    remove_connection(pool, "ws-sw0")
+    pool.update_heartbeat("ws-sw3")
+    result = heartbeat_check(pool, tmp_db, timeout=30)
+    assert result["active"] == ["ws-sw1", "ws-sw2", "ws-sw3"]
+    assert result["active"] == [c.ws_id for c in pool.get_all()]
+    assert result["timed_out"] == []
+
+
+def test_heartbeat_check_sql(pool, tmp_db):
+    add_connection(pool, "ws-sql-stale", "alice")
+    add_connection(pool, "ws-sql-live", "alice")
+    tmp_db.execute(
+        "UPDATE connections SET last_heartbeat='2020-01-01T00:00:00' WHERE ws_id='ws-sql-stale'"
+    )
+    result = heartbeat_check_sql(tmp_db, timeout=30)
+    assert result["timed_out"] == ["ws-sql-stale"]
+    assert "ws-sql-live" in result["active"]
+    assert ConnectionPool(tmp_db).get("ws-sql-stale") is None
+
+
+def test_cli_list_and_history(tmp_path, capsys):
+    from main_module import main
+    db = str(tmp_path / "cli.db")
+    main(["--db", db, "connect", "alice", "--ws-id", "ws-cli-1"])
+    main(["--db", db, "connect", "bob", "--ws-id", "ws-cli-2"])
+    main(["--db", db, "send", "ws-cli-1", "hello"])
+    capsys.readouterr()
+    main(["--db", db, "list"])
+    listed = capsys.readouterr().out.splitlines()
+    assert len(listed) == 2
+    assert "agent=alice" in listed[0] and "msgs=    1" in listed[0]
+    main(["--db", db, "history"])
+    assert capsys.readouterr().out.rstrip().endswith("hello")
+
+
+def test_lazy_pool_and_sql_stats(pool, tmp_db):
+    add_connection(pool, "ws-lazy1", "alice")
+    lazy = ConnectionPool(tmp_db, lazy=True)
+    added = add_connection(lazy, "ws-lazy2", "bob")
+    assert list(lazy._pool) == ["ws-lazy2"]
+    assert lazy.count() == 2
+    assert lazy.get("ws-lazy2") is added
+    stats = connection_stats(None, tmp_db)
+    assert stats["active_connections"] == 2
+    assert stats["agents"] == {"alice": 1, "bob": 1}
+
+
+def test_readonly_connection(tmp_path, pool, tmp_db):
+    add_connection(pool, "ws-ro", "alice")
+    reader = get_db_readonly(tmp_path / "ws_test.db")
+    assert ConnectionPool(tmp_db, reader=reader).get("ws-ro") is not None
+    with pytest.raises(sqlite3.OperationalError):
+        reader.execute("DELETE FROM connections")
+
+
+def test_message_content_encoding(pool, tmp_db):
+    add_connection(pool, "ws-enc", "alice")
+    assert send_message(pool, tmp_db, "ws-enc", "plain text").content == "plain text"
+    encoded = send_message(pool, tmp_db, "ws-enc", {"event": "deploy", "n": 2}).content
+    assert json.loads(encoded) == {"event": "deploy", "n": 2}
+
+
+def test_message_count_persisted_once(pool, tmp_db):
+    add_connection(pool, "ws-trig", "alice")
+    send_message(pool, tmp_db, "ws-trig", "a")
+    send_message(pool, tmp_db, "ws-trig", "b")
+    assert ConnectionPool(tmp_db).get("ws-trig").message_count == 2
+
+
+def test_connection_slots_and_own_metadata():
+    c = Connection(ws_id="ws-slots", agent="alice")
+    assert not hasattr(c, "__dict__")
+    c.metadata["ip"] = "1.2.3.4"
+    assert Connection(ws_id="ws-other", agent="bob").metadata == {}
+
+
+def test_heartbeats_flushed_on_remove_and_exit(tmp_db):
+    with ConnectionPool(tmp_db) as pool:
+        add_connection(pool, "ws-hb-rm", "cipher")
+        add_connection(pool, "ws-hb-keep", "cipher")
+        pool.update_heartbeat("ws-hb-rm", latency_ms=1)
+        pool.update_heartbeat("ws-hb-keep", latency_ms=2)
+        remove_connection(pool, "ws-hb-rm")
+        logged = [r[0] for r in tmp_db.execute("SELECT ws_id FROM heartbeat_log")]
+        assert logged == ["ws-hb-rm", "ws-hb-keep"]
+        pool.update_heartbeat("ws-hb-keep", latency_ms=3)
+    logged = tmp_db.execute("SELECT COUNT(*) FROM heartbeat_log").fetchone()[0]
+    assert logged == 3
+
+
+def test_broadcast_by_agent_keeps_insertion_order(pool, tmp_db):
+    ids = [f"ag{i}" for i in range(8)]
+    for ws_id in ids:
+        add_connection(pool, ws_id, "fleet")
+    assert broadcast(pool, tmp_db, "hi", agent="fleet") == ids
+    assert broadcast(pool, tmp_db, "hi", filter_fn=lambda c: c.agent == "fleet") == ids
+
+
+@pytest.mark.parametrize("payload", [
+    {1: "x"}, {"n": 2**70}, {"name": "é"},
+    {"v": float("nan")}, {"v": float("inf")}, [float("-inf"), None],
+])
+def test_content_encoding_accepts_stdlib_json_payloads(pool, tmp_db, payload):
+    add_connection(pool, "ws-payload", "alice")
+    assert broadcast(pool, tmp_db, payload) == ["ws-payload"]
+    stored = tmp_db.execute("SELECT content FROM messages").fetchone()[0]
+    assert stored == json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def test_metadata_with_non_str_keys(pool, tmp_db):
+    add_connection(pool, "ws-intkey", "alice", {1: "x"})
+    stored = tmp_db.execute(
+        "SELECT metadata FROM connections WHERE ws_id='ws-intkey'"
+    ).fetchone()[0]
+    assert json.loads(stored) == {"1": "x"}
+
+
+def test_loaded_empty_metadata_not_shared(pool, tmp_db):
+    add_connection(pool, "ws-e1", "alice")
+    add_connection(pool, "ws-e2", "alice")
+    reloaded = ConnectionPool(tmp_db)
+    reloaded.get("ws-e1").metadata["ip"] = "1.2.3.4"
+    assert reloaded.get("ws-e2").metadata == {}
+
+
+def test_heartbeat_check_sql_sees_buffered_heartbeats(pool, tmp_db):
+    add_connection(pool, "ws-buffered", "alice")
+    tmp_db.execute(
+        "UPDATE connections SET last_heartbeat='2020-01-01T00:00:00' WHERE ws_id='ws-buffered'"
+    )
+    pool._hb_last_flush = time.monotonic()
+    pool.update_heartbeat("ws-buffered")
+    assert pool._hb_buffer  # still only in memory
+    result = heartbeat_check_sql(tmp_db, timeout=30, pool=pool)
+    assert result["timed_out"] == []
+    assert "ws-buffered" in result["active"]
+
+
+def test_send_commits_on_default_isolation_connection(pool, tmp_path):
+    add_connection(pool, "ws-iso", "alice")
+    legacy = sqlite3.connect(str(tmp_path / "ws_test.db"))
+    send_message(pool, legacy, "ws-iso", "hi")
+    broadcast(pool, legacy, "all")
+    assert not legacy.in_transaction
+
+
+def test_pool_on_default_isolation_connection(tmp_db, tmp_path):
+    legacy = sqlite3.connect(str(tmp_path / "ws_test.db"))
+    legacy.row_factory = sqlite3.Row
+    pool = ConnectionPool(legacy)
+    add_connection(pool, "ws-legacy1", "alice")
+    assert not legacy.in_transaction
+    pool.update_heartbeat("ws-legacy1", latency_ms=1)
+    legacy.execute("UPDATE connections SET agent=agent WHERE 0")  # implicit BEGIN
+    assert legacy.in_transaction
+    pool.flush()
+    pool.add_many([Connection(ws_id="ws-legacy2", agent="alice")])
+    pool.remove("ws-legacy1")
+    assert not legacy.in_transaction
+    rows = dict(tmp_db.execute(
+        "SELECT ws_id, status FROM connections WHERE ws_id LIKE 'ws-legacy%'"
+    ).fetchall())
+    assert rows == {"ws-legacy1": "disconnected", "ws-legacy2": "active"}
+    assert tmp_db.execute("SELECT COUNT(*) FROM heartbeat_log").fetchone()[0] == 1
+
+
+def test_heartbeat_check_order_after_remove_many(pool, tmp_db):
+    for i in range(6):
+        add_connection(pool, f"ws-ord{i}", "alice")
+    pool.remove_many(["ws-ord1", "ws-ord4"])
+    pool.update_heartbeat("ws-ord5")
+    result = heartbeat_check(pool, tmp_db, timeout=30)
+    assert result["active"] == ["ws-ord0", "ws-ord2", "ws-ord3", "ws-ord5"]
+
+
+def test_heartbeat_check_sql_default_timestamp_row(tmp_db):
+    tmp_db.execute("INSERT INTO connections(ws_id, agent) VALUES('ws-default-ts', 'alice')")
+    result = heartbeat_check_sql(tmp_db, timeout=30)
+    assert result["timed_out"] == []
+    assert result["active"] == ["ws-default-ts"]
+    assert heartbeat_check(ConnectionPool(tmp_db), tmp_db, timeout=30)["active"] == ["ws-default-ts"]
+
+
+@pytest.mark.parametrize("payload", [
+    {"at": datetime(2026, 1, 1)},
+    Message(content="nested"),
+])
+def test_content_encoding_rejects_what_stdlib_rejects(pool, tmp_db, payload):
+    add_connection(pool, "ws-reject", "alice")
+    with pytest.raises(TypeError):
+        broadcast(pool, tmp_db, payload)
+
+
+def test_content_encoding_uuid(pool, tmp_db):
+    add_connection(pool, "ws-uuid", "alice")
+    value = uuid.uuid4()
+    broadcast(pool, tmp_db, {"id": value})
+    stored = tmp_db.execute("SELECT content FROM messages").fetchone()[0]
+    assert stored == '{"id":"%s"}' % value